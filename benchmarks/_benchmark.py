@@ -114,9 +114,9 @@ class Benchmark(conbench.runner.Benchmark):
         if isinstance(source, _sources.Source):
             return [source]
         if source == "ALL":
-            return [_sources.Source(s) for s in self.sources]
+            return [_sources.get_source(s) for s in self.sources]
         if source == "TEST":
-            return [_sources.Source(s) for s in self.sources_test]
+            return [_sources.get_source(s) for s in self.sources_test]
 
         available_sources = [
             "ALL",
@@ -128,7 +128,7 @@ class Benchmark(conbench.runner.Benchmark):
             msg = f"Source can only be one of {available_sources}."
             raise Exception(msg)
 
-        return [_sources.Source(source)]
+        return [_sources.get_source(source)]
 
     def get_tags(self, options, source=None):
         info = {"cpu_count": options.get("cpu_count", None)}
@@ -1,13 +1,11 @@
+import concurrent.futures
 import functools
+import importlib
+import json
+import logging
 import os
 import pathlib
-
-import pandas
-import pyarrow
-import pyarrow.csv
-import pyarrow.feather as feather
-import pyarrow.parquet as parquet
-import requests
+import threading
 
 from enum import Enum
 
@@ -16,27 +14,128 @@ this_dir = os.path.dirname(os.path.abspath(__file__))
 local_data_dir = os.path.join(this_dir, "data")
 data_dir = os.getenv("BENCHMARKS_DATA_DIR", local_data_dir)
 temp_dir = os.path.join(data_dir, "temp")
+manifest_path = os.path.join(data_dir, "manifest.json")
+_temp_dir_created = False
+
+# Imported on first use, most sources only ever touch one format.
+_LAZY_MODULES = {
+    "pandas": "pandas",
+    "pyarrow": "pyarrow",
+    "csv": "pyarrow.csv",
+    "feather": "pyarrow.feather",
+    "parquet": "pyarrow.parquet",
+    "requests": "requests",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_LAZY_MODULES[name])
+    globals()[name] = module
+    return module
+
+
+@functools.lru_cache(maxsize=1)
+def _session():
+    """One requests session for the process, shared by the download
+    workers and across Sources so connections get reused.
+    """
+    import requests
+
+    return requests.Session()
+
+
+_manifest_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
+def _manifest():
+    """Verified sizes of the files downloaded into data/, keyed by
+    absolute path.
+    """
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _is_downloaded(path):
+    with _manifest_lock:
+        entry = _manifest().get(os.path.abspath(path))
+    if entry is None:
+        return False
+    return _file_size(path) == entry["size"]
+
+
+def _record_downloads(sizes):
+    """Add {path: size} entries to the manifest with a single rewrite."""
+    if not sizes:
+        return
+    with _manifest_lock:
+        manifest = _manifest()
+        for path, size in sizes.items():
+            manifest[os.path.abspath(path)] = {"size": size}
+        tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+
+
+def _content_length(response):
+    """The number of body bytes to expect, if the server says so and
+    iter_content won't decode (and so resize) the body.
+    """
+    headers = response.headers
+    if "Content-Length" not in headers or headers.get("Content-Encoding"):
+        return None
+    return int(headers["Content-Length"])
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return None
+
+
+def _keep_local_copy(path, error):
+    """Whether to carry on with an unverified copy of path when the remote
+    size can't be looked up, e.g. when offline.
+    """
+    if _file_size(path) is None:
+        return False
+    logging.warning(f"Could not verify {path} ({error}), using the local copy")
+    return True
 
 
 def _local(name):
     """Sources for unit testing, committed to benchmarks/data."""
-    return os.path.join(local_data_dir, name)
+    return f"{local_data_dir}{os.sep}{name}"
 
 
 def _source(name):
     """Sources downloaded from S3 and otherwise untouched."""
-    return os.path.join(data_dir, name)
+    return f"{data_dir}{os.sep}{name}"
 
 
 def _temp(name):
     """Sources generated from the canonical sources."""
-    return os.path.join(temp_dir, name)
+    return f"{temp_dir}{os.sep}{name}"
 
 
-def munge_compression(c, file_type):
-    if file_type == "parquet":
-        c = "NONE" if c == "uncompressed" else c
-    return c.lower() if file_type == "feather" else c.upper()
+@functools.lru_cache(maxsize=None)
+def _repartitioned_paths():
+    """~13k paths, only built if the repartitioned source is used."""
+    return [
+        f"ursa-labs-taxi-data-repartitioned-10k/{year}/{month:02}/{part:04}/data.parquet"
+        for year in range(2009, 2020)
+        for month in range(1, 13)
+        for part in range(101)
+        if not (year == 2019 and month > 6)  # Data ends in 2019/06
+        and not (year == 2010 and month == 3)  # Data is missing in 2010/03
+    ]
 
 
 class SourceFormat(Enum):
@@ -45,6 +144,13 @@ class SourceFormat(Enum):
     FEATHER = "feather"
 
 
+def munge_compression(c, file_type):
+    entry = _FORMAT_DISPATCH[SourceFormat(file_type)]
+    if c == "uncompressed":
+        c = entry.get("uncompressed_alias", c)
+    return entry["munge"](c)
+
+
 STORE = {
     "fanniemae_sample": {
         "path": _local("fanniemae_sample.csv"),
@@ -153,14 +259,7 @@ STORE = {
     },
     "nyctaxi_multi_parquet_s3_repartitioned": {
         "download": False,
-        "paths": [
-            f"ursa-labs-taxi-data-repartitioned-10k/{year}/{month:02}/{part:04}/data.parquet"
-            for year in range(2009, 2020)
-            for month in range(1, 13)
-            for part in range(101)
-            if not (year == 2019 and month > 6)  # Data ends in 2019/06
-            and not (year == 2010 and month == 3)  # Data is missing in 2010/03
-        ],
+        "paths": _repartitioned_paths,
         "region": "us-east-2",
         "format": SourceFormat.PARQUET,
     },
@@ -193,7 +292,10 @@ class Source:
     benchmarking.
 
     Files in the "data/temp/" folder are the result of running
-    benchmarks, and are derived from the canonical source files.
+    benchmarks, and are derived from the canonical source files. The
+    "*.table.feather" files there cache Source.table between runs. Their
+    names include the source file's size and mtime (omitted above), so a
+    re-downloaded source never reuses stale derived files.
 
     If a source file isn't initially found in the data folder on disk,
     it will be downloaded from the source location (like S3) and
@@ -211,18 +313,47 @@ class Source:
     def tags(self):
         return {"dataset": self.name}
 
-    @property
+    @functools.cached_property
     def paths(self):
-        return self.store.get("paths", [])
+        paths = self.store.get("paths", [])
+        return paths() if callable(paths) else paths
 
-    @property
+    @functools.cached_property
     def region(self):
         return self.store.get("region")
 
-    @property
+    @functools.cached_property
+    def filesystem(self):
+        """The S3 filesystem holding the source paths, if any."""
+        if not self.region:
+            return None
+
+        import pyarrow.fs
+
+        return pyarrow.fs.S3FileSystem(region=self.region, anonymous=True)
+
+    @functools.cached_property
     def csv_parse_options(self):
+        if "sep" not in self.store:
+            return None
+
+        import pyarrow.csv
+
         return pyarrow.csv.ParseOptions(delimiter=self.store["sep"])
 
+    @functools.cached_property
+    def csv_read_options(self):
+        if "sep" not in self.store:
+            return None
+
+        import pyarrow.csv
+
+        column_names = None
+        if self.store["header"] is None:
+            # name headerless columns "0", "1", ... like pandas used to
+            column_names = [str(i) for i in range(self._csv_column_count())]
+        return pyarrow.csv.ReadOptions(column_names=column_names, block_size=64 << 20)
+
     @property
     def source_path(self):
         """A path in the benchmarks data/ folder.
@@ -232,7 +363,7 @@ class Source:
         """
         return self.store.get("path")
 
-    @property
+    @functools.cached_property
     def source_paths(self):
         if self.paths:
             return [_source(path) for path in self.paths]
@@ -241,7 +372,7 @@ class Source:
         else:
             return []
 
-    @property
+    @functools.cached_property
     def format_str(self):
         return self.store.get("format").value
 
@@ -249,12 +380,27 @@ class Source:
         """A path in the benchmarks data/temp/ folder.
 
         For example:
-            data/temp/nyctaxi_sample.snappy.parquet
+            data/temp/nyctaxi_sample.182665-1618412345.snappy.parquet
 
-        If the data/temp/ folder does not exist, it will be created.
+        Where "182665-1618412345" is the size & mtime of the source file
+        it was derived from (sources without a local file have no key).
+
+        If the data/temp/ folder does not exist, it will be created (the
+        first time this is called in a process).
         """
-        pathlib.Path(temp_dir).mkdir(exist_ok=True)
-        return pathlib.Path(_temp(f"{self.name}.{compression}.{file_type}"))
+        global _temp_dir_created
+        if not _temp_dir_created:
+            pathlib.Path(temp_dir).mkdir(parents=True, exist_ok=True)
+            _temp_dir_created = True
+        name = ".".join(filter(None, [self.name, self._cache_key]))
+        return pathlib.Path(_temp(f"{name}.{compression}.{file_type}"))
+
+    @functools.cached_property
+    def _cache_key(self):
+        if not self.source_path:
+            return None
+        st = os.stat(self.source_path)
+        return f"{st.st_size}-{int(st.st_mtime)}"
 
     def create_if_not_exists(self, file_type, compression):
         """Used to create files for benchmarking based on the canonical
@@ -264,77 +410,308 @@ class Source:
             source = _source.Source("nyctaxi_sample")
             source.create_if_not_exists("parquet", "snappy")
 
-        Will create the following file:
-            data/temp/nyctaxi_sample.snappy.parquet
+        Will create the following file (see temp_path for the key):
+            data/temp/nyctaxi_sample.182665-1618412345.snappy.parquet
 
         Using the following source file:
             data/nyctaxi_sample.csv
         """
         path = self.temp_path(file_type, compression)
         if not path.exists():
-            if file_type == "feather":
-                self._feather_write(self.table, path, compression)
-            elif file_type == "parquet":
-                self._parquet_write(self.table, path, compression)
+            writer = _FORMAT_DISPATCH[SourceFormat(file_type)].get("writer")
+            if writer is None:
+                raise ValueError(f"Can't create {file_type} files from sources.")
+            writer(self, self.table, path, compression)
         return path
 
     @functools.cached_property
     def dataframe(self):
-        if self._table is not None:
-            # this takes ~ 7 seconds for fanniemae_2016Q4
-            return self.table.to_pandas()
-        else:
-            # this takes ~ 199 seconds for fanniemae_2016Q4
-            return pandas.read_csv(
-                self.store["path"],
-                sep=self.store["sep"],
-                header=self.store["header"],
-                low_memory=False,
-            )
+        # Source.table stays the single cached copy, so no self_destruct
+        return self.table.to_pandas(use_threads=True, split_blocks=True)
 
     @functools.cached_property
     def table(self):
-        path = self.temp_path("feather", "lz4")
-        if path.exists():
-            # this takes ~ 3 seconds for fanniemae_2016Q4
-            self._table = feather.read_table(path, memory_map=False)
-        else:
-            # this takes ~ 205 seconds for fanniemae_2016Q4
-            self._table = pyarrow.Table.from_pandas(
-                self.dataframe,
-                preserve_index=False,
-            ).replace_schema_metadata(None)
+        self._table = self.read_table()
         return self._table
 
-    def _get_object_url(self, idx=0):
+    def read_table(self, columns=None):
+        """Read the source as an arrow table, optionally with just the
+        given columns.
+
+        Parquet and Feather skip the unselected columns on disk, and an
+        already loaded Source.table is projected without a copy.
+        """
+        import pyarrow
+        import pyarrow.feather as feather
+
+        if self._table is not None:
+            return self._table if columns is None else self._table.select(columns)
+
+        # zstd (at Arrow's default level 1) is ~30% smaller than lz4 on
+        # these sources, so cold reads touch less disk. Not shared with
+        # the benchmark outputs in data/temp/, since those get overwritten
+        # while this table may still be in use.
+        path = self.temp_path("table.feather", "zstd")
+        if path.exists():
+            try:
+                return feather.read_table(path, columns=columns, memory_map=True)
+            except pyarrow.ArrowInvalid:
+                # unreadable cache (e.g. left by an older, interrupted write)
+                path.unlink()
+
+        table = self._read_source(columns)
+        if columns is None:
+            # write next to the cache, then move it into place so an
+            # interrupted run never leaves a truncated cache at path
+            part_path = path.with_name(path.name + ".part")
+            self._feather_write(table, part_path, "zstd")
+            os.replace(part_path, path)
+        return table
+
+    def _read_source(self, columns=None):
         if self.paths:
-            s3_url = pathlib.Path(self.paths[idx])
-            return (
-                "https://"
-                + s3_url.parts[0]
-                + ".s3."
-                + self.region
-                + ".amazonaws.com/"
-                + os.path.join(*s3_url.parts[1:])
-            )
+            # multi-file sources: files are read & concatenated on Arrow's
+            # thread pool rather than one after another
+            return self.dataset().to_table(columns=columns, use_threads=True)
+        reader = _FORMAT_DISPATCH[self.store["format"]]["reader"]
+        return reader(self, columns)
+
+    def iter_batches(self, batch_size=65_536, columns=None):
+        """Yield the source file as record batches of at most batch_size
+        rows, so benchmarks that only scan it don't need the whole table
+        in memory.
+
+        Multi-file sources are scanned through Source.dataset().
+        """
+        if self.paths:
+            yield from self.dataset().to_batches(columns=columns, batch_size=batch_size)
+            return
+        batches = _FORMAT_DISPATCH[self.store["format"]]["batches"]
+        yield from batches(self, batch_size, columns)
+
+    def dataset(self):
+        """A pyarrow dataset over the source files, so benchmarks can push
+        column projections and row filters down into the scanner.
+
+        For example:
+            source.dataset().to_table(columns=["foo"], filter=field("bar") > 0)
+        """
+        import pyarrow.dataset
 
-        return self.store.get("source")
+        file_format = self.format_str
+        if self.store["format"] == SourceFormat.CSV:
+            file_format = pyarrow.dataset.CsvFileFormat(
+                parse_options=self.csv_parse_options,
+                read_options=self.csv_read_options,
+            )
+        if not self.store.get("download", True):
+            return pyarrow.dataset.dataset(
+                self.paths, format=file_format, filesystem=self.filesystem
+            )
+        return pyarrow.dataset.dataset(self.source_paths, format=file_format)
+
+    def _csv_read(self, columns=None):
+        import pyarrow.csv
+
+        # this takes ~ 7 seconds for fanniemae_2016Q4 (vs ~ 205 seconds
+        # via pandas.read_csv & Table.from_pandas)
+        return pyarrow.csv.read_csv(
+            self.source_path,
+            read_options=self.csv_read_options,
+            parse_options=self.csv_parse_options,
+            convert_options=self._csv_convert_options(columns),
+        )
+
+    def _csv_batches(self, batch_size, columns):
+        import pyarrow.csv
+
+        reader = pyarrow.csv.open_csv(
+            self.source_path,
+            read_options=self.csv_read_options,
+            parse_options=self.csv_parse_options,
+            convert_options=self._csv_convert_options(columns),
+        )
+        # the reader yields one batch per (64 MiB) block, so re-slice
+        # those (zero-copy) down to batch_size rows
+        for block in reader:
+            for offset in range(0, len(block), batch_size):
+                yield block.slice(offset, batch_size)
+
+    def _parquet_read(self, columns=None):
+        import pyarrow.parquet as parquet
+
+        return parquet.read_table(
+            self.source_path, columns=columns, use_threads=True, pre_buffer=True
+        )
+
+    def _parquet_batches(self, batch_size, columns):
+        import pyarrow.parquet as parquet
+
+        parquet_file = parquet.ParquetFile(
+            self.source_path, pre_buffer=True, buffer_size=8 << 20
+        )
+        yield from parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+
+    def _feather_read(self, columns=None):
+        import pyarrow.feather as feather
+
+        return feather.read_table(self.source_path, columns=columns, memory_map=True)
+
+    def _feather_batches(self, batch_size, columns):
+        import pyarrow.feather as feather
+
+        table = feather.read_table(self.source_path, columns=columns, memory_map=True)
+        yield from table.to_batches(max_chunksize=batch_size)
+
+    def _csv_convert_options(self, columns):
+        import pyarrow.csv
+
+        convert_options = pyarrow.csv.ConvertOptions()
+        if columns is not None:
+            convert_options.include_columns = columns
+        return convert_options
+
+    def _csv_column_count(self):
+        import pyarrow.csv
+
+        # only parses the first (small) block to infer the schema
+        read_options = pyarrow.csv.ReadOptions(
+            autogenerate_column_names=True, block_size=1 << 20
+        )
+        reader = pyarrow.csv.open_csv(
+            self.source_path,
+            read_options=read_options,
+            parse_options=self.csv_parse_options,
+        )
+        return len(reader.schema)
 
     def download_source_if_not_exists(self):
-        for idx, path in enumerate(self.source_paths):
-            source_path = pathlib.Path(path)
-            if not source_path.exists():
-                source_path.parent.mkdir(parents=True, exist_ok=True)
-                source = self.store.get("source")
-                if not source:
-                    source = self._get_object_url(idx)
-                r = requests.get(source)
-                open(source_path, "wb").write(r.content)
+        if not self.store.get("source") and not self.paths:
+            return  # committed sample data, nothing to fetch
+        pending = [
+            (idx, pathlib.Path(path))
+            for idx, path in enumerate(self.source_paths)
+            if not _is_downloaded(path)
+        ]
+        if not pending:
+            return
+        # downloads are I/O bound, so fetch multi-file sources concurrently
+        sizes, errors = {}, []
+        workers = min(32, len(pending))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(self._download, idx, path): path for idx, path in pending
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    size = future.result()
+                except Exception as e:
+                    errors.append(e)
+                else:
+                    if size is not None:
+                        sizes[futures[future]] = size
+        # record whatever did succeed, so a retry only fetches the rest
+        _record_downloads(sizes)
+        if errors:
+            raise errors[0]
+
+    def _download(self, idx, source_path):
+        """Fetch one source file, unless a copy of the expected size is
+        already on disk, and return its verified size (None if an existing
+        copy had to be kept without verifying it).
+        """
+        import pyarrow.fs
+
+        source_path.parent.mkdir(parents=True, exist_ok=True)
+        # download next to the destination, then move it into place so an
+        # interrupted run never leaves a partial file at source_path
+        part_path = source_path.with_name(source_path.name + ".part")
+        try:
+            if self.filesystem is not None:
+                try:
+                    expected = self.filesystem.get_file_info(self.paths[idx]).size
+                except OSError as e:
+                    if not _keep_local_copy(source_path, e):
+                        raise
+                    return None
+                if expected is not None and _file_size(source_path) == expected:
+                    return expected
+                # multi-threaded ranged reads via the AWS SDK
+                pyarrow.fs.copy_files(
+                    self.paths[idx],
+                    str(part_path),
+                    source_filesystem=self.filesystem,
+                )
+                with open(part_path, "rb") as f:
+                    os.fsync(f.fileno())
+            else:
+                try:
+                    r = _session().get(self.store["source"], stream=True, timeout=60)
+                    r.raise_for_status()
+                except OSError as e:
+                    if not _keep_local_copy(source_path, e):
+                        raise
+                    return None
+                with r:
+                    expected = _content_length(r)
+                    if expected is not None and _file_size(source_path) == expected:
+                        return expected
+                    with open(part_path, "wb") as f:
+                        for chunk in r.iter_content(chunk_size=8 << 20):
+                            f.write(chunk)
+                        f.flush()
+                        os.fsync(f.fileno())
+            size = part_path.stat().st_size
+            if expected is not None and size != expected:
+                raise IOError(
+                    f"Downloaded {size} of {expected} bytes for {source_path.name}"
+                )
+        except BaseException:
+            part_path.unlink(missing_ok=True)
+            raise
+        os.replace(part_path, source_path)
+        return size
 
     def _feather_write(self, table, path, compression):
+        import pyarrow.feather as feather
+
         compression = munge_compression(compression, "feather")
         feather.write_feather(table, path, compression=compression)
 
     def _parquet_write(self, table, path, compression):
+        import pyarrow.parquet as parquet
+
         compression = munge_compression(compression, "parquet")
         parquet.write_table(table, path, compression=compression)
+
+
+# Per-format hooks, so supporting another format (ORC, Lance, ...) is a
+# new entry here rather than another branch in every dispatcher.
+_FORMAT_DISPATCH = {
+    SourceFormat.CSV: {
+        "munge": str.upper,
+        "reader": Source._csv_read,
+        "batches": Source._csv_batches,
+    },
+    SourceFormat.PARQUET: {
+        "munge": str.upper,
+        "uncompressed_alias": "NONE",
+        "reader": Source._parquet_read,
+        "batches": Source._parquet_batches,
+        "writer": Source._parquet_write,
+    },
+    SourceFormat.FEATHER: {
+        "munge": str.lower,
+        "reader": Source._feather_read,
+        "batches": Source._feather_batches,
+        "writer": Source._feather_write,
+    },
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_source(name):
+    """Preferred way to get a Source: instances are shared per name, so a
+    sweep over the same dataset downloads, checks and loads it once.
+    """
+    return Source(name)
@@ -0,0 +1,334 @@
+import io
+import json
+import os
+import shutil
+
+import pyarrow
+import pyarrow.fs
+import pytest
+
+from .. import _sources
+
+
+SAMPLE_CSV = os.path.join(_sources.local_data_dir, "nyctaxi_sample.csv")
+SAMPLE_PARQUET = os.path.join(_sources.local_data_dir, "chi_traffic_sample.parquet")
+
+
+class FakeResponse:
+    def __init__(self, body, content_length=None, fail_at=None):
+        self.body = body
+        length = len(body) if content_length is None else content_length
+        self.headers = {"Content-Length": str(length)}
+        self.fail_at = fail_at
+        self.read = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        self.read = True
+        stream = io.BytesIO(self.body)
+        while chunk := stream.read(1024):
+            if self.fail_at is not None and stream.tell() > self.fail_at:
+                raise ConnectionError("stream interrupted")
+            yield chunk
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+
+    def get(self, url, **kwargs):
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def data_dir(monkeypatch, tmp_path):
+    """Point the data/, data/temp/ and manifest paths at tmp_path."""
+    monkeypatch.setattr(_sources, "data_dir", str(tmp_path / "data"))
+    monkeypatch.setattr(_sources, "temp_dir", str(tmp_path / "data" / "temp"))
+    monkeypatch.setattr(_sources, "manifest_path", str(tmp_path / "manifest.json"))
+    monkeypatch.setattr(_sources, "_temp_dir_created", False)
+    _sources._manifest.cache_clear()
+    yield tmp_path
+    _sources._manifest.cache_clear()
+
+
+@pytest.fixture
+def http_source(monkeypatch, data_dir):
+    """A CSV source whose download goes through a FakeSession."""
+    path = data_dir / "data" / "http_sample.csv"
+    store = {
+        "path": str(path),
+        "source": "https://example.com/http_sample.csv",
+        "sep": ",",
+        "header": 0,
+        "format": _sources.SourceFormat.CSV,
+    }
+    monkeypatch.setitem(_sources.STORE, "http_sample", store)
+    with open(SAMPLE_CSV, "rb") as f:
+        body = f.read()
+
+    def download(*responses):
+        session = FakeSession(*responses)
+        monkeypatch.setattr(_sources, "_session", lambda: session)
+        return _sources.Source("http_sample")
+
+    return path, body, download
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch, data_dir):
+    """Two parquet files served through Source.filesystem from tmp_path."""
+    bucket = data_dir / "bucket"
+    paths = ["taxi/2009/01/data.parquet", "taxi/2009/02/data.parquet"]
+    for path in paths:
+        (bucket / path).parent.mkdir(parents=True)
+        shutil.copy(SAMPLE_PARQUET, bucket / path)
+    filesystem = pyarrow.fs.SubTreeFileSystem(str(bucket), pyarrow.fs.LocalFileSystem())
+    monkeypatch.setattr(_sources.Source, "filesystem", filesystem)
+    return paths
+
+
+def test_csv_table():
+    source = _sources.Source("fanniemae_sample")
+    table = source.table
+    assert isinstance(table, pyarrow.Table)
+    assert table.num_rows == 757
+    assert table.column_names[:3] == ["0", "1", "2"]
+
+
+def test_csv_dataframe():
+    source = _sources.Source("nyctaxi_sample")
+    dataframe = source.dataframe
+    assert dataframe.shape == (source.table.num_rows, source.table.num_columns)
+    assert list(dataframe.columns) == source.table.column_names
+
+
+def test_parquet_table():
+    source = _sources.Source("chi_traffic_sample")
+    table = source.table
+    assert isinstance(table, pyarrow.Table)
+    assert table.num_rows > 0
+    assert len(source.dataframe) == table.num_rows
+
+
+def test_csv_options():
+    source = _sources.Source("fanniemae_sample")
+    assert source.csv_parse_options.delimiter == "|"
+    assert source.csv_parse_options is source.csv_parse_options
+    assert _sources.Source("chi_traffic_sample").csv_parse_options is None
+
+
+def test_iter_batches():
+    for name in ["fanniemae_sample", "nyctaxi_sample", "chi_traffic_sample"]:
+        source = _sources.Source(name)
+        columns = source.table.column_names[:2]
+        batches = list(source.iter_batches(batch_size=100, columns=columns))
+        assert sum(len(batch) for batch in batches) == source.table.num_rows
+        assert all(len(batch) <= 100 for batch in batches)
+        assert len(batches) >= -(-source.table.num_rows // 100)
+        assert batches[0].schema.names == columns
+
+
+def test_read_table_columns():
+    for name in ["fanniemae_sample", "nyctaxi_sample", "chi_traffic_sample"]:
+        source = _sources.Source(name)
+        columns = source.table.column_names[1:3]
+        expected = source.table.select(columns)
+        assert _sources.Source(name).read_table(columns=columns).equals(expected)
+
+
+def test_dataset():
+    for name in ["fanniemae_sample", "nyctaxi_sample", "chi_traffic_sample"]:
+        source = _sources.Source(name)
+        columns = source.table.column_names[:2]
+        table = source.dataset().to_table(columns=columns)
+        assert table.equals(source.table.select(columns))
+
+
+def test_get_source():
+    source = _sources.get_source("nyctaxi_sample")
+    assert source is _sources.get_source("nyctaxi_sample")
+    assert source is not _sources.Source("nyctaxi_sample")
+
+
+def test_table_cache_rebuilt_when_corrupt(data_dir):
+    source = _sources.Source("nyctaxi_sample")
+    expected = source.table
+    path = source.temp_path("table.feather", "zstd")
+    assert path.exists()
+    assert data_dir in path.parents
+    assert not path.with_name(path.name + ".part").exists()
+    with open(path, "r+b") as f:
+        f.truncate(10)
+    assert _sources.Source("nyctaxi_sample").table.equals(expected)
+    assert _sources.Source("nyctaxi_sample").table.equals(expected)
+
+
+def assert_manifest(path, size):
+    with open(_sources.manifest_path) as f:
+        manifest = json.load(f)
+    assert manifest.get(os.path.abspath(path)) == (size and {"size": size})
+
+
+def test_download(http_source):
+    path, body, download = http_source
+    download(FakeResponse(body))
+    assert path.read_bytes() == body
+    assert not path.with_name(path.name + ".part").exists()
+    assert_manifest(path, len(body))
+
+
+def test_download_failed_stream_then_retry(http_source):
+    path, body, download = http_source
+    with pytest.raises(ConnectionError):
+        download(FakeResponse(body, fail_at=4096))
+    assert not path.exists()
+    assert not path.with_name(path.name + ".part").exists()
+    assert not os.path.exists(_sources.manifest_path)
+
+    download(FakeResponse(body))
+    assert path.read_bytes() == body
+    assert_manifest(path, len(body))
+
+
+def test_download_short_transfer(http_source):
+    path, body, download = http_source
+    with pytest.raises(IOError, match="Downloaded"):
+        download(FakeResponse(body, content_length=len(body) + 10))
+    assert not path.exists()
+    assert not path.with_name(path.name + ".part").exists()
+
+
+def test_download_size_mismatch_refetches(http_source):
+    path, body, download = http_source
+    download(FakeResponse(body))
+    with open(path, "r+b") as f:
+        f.truncate(100)
+    response = FakeResponse(body)
+    download(response)
+    assert response.read
+    assert path.read_bytes() == body
+
+
+def test_download_adopts_verified_unrecorded_file(http_source):
+    path, body, download = http_source
+    path.parent.mkdir(parents=True)
+    path.write_bytes(body)
+    response = FakeResponse(body)
+    download(response)
+    assert not response.read
+    assert_manifest(path, len(body))
+
+    # recorded now, so no request at all next time
+    download()
+
+
+def test_download_keeps_unrecorded_file_when_offline(http_source, monkeypatch):
+    path, body, download = http_source
+    path.parent.mkdir(parents=True)
+    path.write_bytes(body)
+
+    class OfflineSession:
+        def get(self, url, **kwargs):
+            raise ConnectionError("offline")
+
+    monkeypatch.setattr(_sources, "_session", lambda: OfflineSession())
+    source = _sources.Source("http_sample")
+    assert source.table.num_rows == _sources.Source("nyctaxi_sample").table.num_rows
+    assert path.read_bytes() == body
+    assert not os.path.exists(_sources.manifest_path)
+
+    # no local copy to fall back on
+    path.unlink()
+    with pytest.raises(ConnectionError):
+        _sources.Source("http_sample")
+
+
+def test_download_s3(s3_bucket, monkeypatch):
+    store = {
+        "paths": s3_bucket,
+        "region": "us-east-2",
+        "format": _sources.SourceFormat.PARQUET,
+    }
+    monkeypatch.setitem(_sources.STORE, "s3_sample", store)
+    source = _sources.Source("s3_sample")
+    size = os.path.getsize(SAMPLE_PARQUET)
+    for path in source.source_paths:
+        assert os.path.getsize(path) == size
+        assert_manifest(path, size)
+
+
+@pytest.mark.parametrize("file_type", ["parquet", "feather"])
+@pytest.mark.parametrize("compression", ["uncompressed", "snappy", "lz4", "zstd"])
+def test_munge_compression(file_type, compression):
+    # the string compares munge_compression used before the dispatch table
+    expected = compression
+    if file_type == "parquet" and compression == "uncompressed":
+        expected = "NONE"
+    expected = expected.lower() if file_type == "feather" else expected.upper()
+    assert _sources.munge_compression(compression, file_type) == expected
+
+
+def test_create_if_not_exists_unsupported_format(data_dir):
+    source = _sources.Source("nyctaxi_sample")
+    with pytest.raises(ValueError, match="csv"):
+        source.create_if_not_exists("csv", "uncompressed")
+
+
+def test_temp_path_follows_source_changes(monkeypatch, data_dir):
+    path = data_dir / "data" / "keyed_sample.csv"
+    path.parent.mkdir(parents=True)
+    shutil.copy(SAMPLE_CSV, path)
+    store = dict(_sources.STORE["nyctaxi_sample"], path=str(path))
+    monkeypatch.setitem(_sources.STORE, "keyed_sample", store)
+
+    source = _sources.Source("keyed_sample")
+    rows = source.table.num_rows
+    cache_path = source.temp_path("table.feather", "zstd")
+    assert cache_path.exists()
+
+    # same size, new mtime
+    os.utime(path, (0, 0))
+    source = _sources.Source("keyed_sample")
+    assert source.temp_path("table.feather", "zstd") != cache_path
+
+    # fewer rows, so the cache must be rebuilt rather than reused
+    with open(SAMPLE_CSV) as f:
+        lines = f.readlines()
+    path.write_text("".join(lines[:100]))
+    assert _sources.Source("keyed_sample").table.num_rows < rows
+
+
+def test_multi_file_source(s3_bucket, monkeypatch):
+    store = {
+        "download": False,
+        "paths": s3_bucket,
+        "region": "us-east-2",
+        "format": _sources.SourceFormat.PARQUET,
+    }
+    monkeypatch.setitem(_sources.STORE, "multi_sample", store)
+    single = _sources.Source("chi_traffic_sample").table
+    columns = single.column_names[:2]
+
+    source = _sources.Source("multi_sample")
+    projected = source.read_table(columns=columns)
+    assert projected.column_names == columns
+    assert projected.num_rows == 2 * single.num_rows
+
+    table = source.table
+    assert table.num_rows == 2 * single.num_rows
+    assert table.select(columns).equals(projected)
+
+    batches = list(
+        _sources.Source("multi_sample").iter_batches(batch_size=100, columns=columns)
+    )
+    assert sum(len(batch) for batch in batches) == 2 * single.num_rows
+    assert all(batch.schema.names == columns for batch in batches)